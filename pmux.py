@@ -7,9 +7,18 @@ import string
 import curses
 import os
 import argparse
+import itertools
+import copy
+import time
+import signal
+import fnmatch
+import re
+import shlex
 
 user_config_file = os.path.expanduser("~/.pmux.yaml")
 verbose = False
+shell_commands = ['bash', 'sh', 'zsh', 'fish', 'dash', 'ksh', 'ssh']
+default_shell = '/bin/bash'
 
 class NameCommandList:
     def __init__(self):
@@ -215,6 +224,34 @@ def verify_ssh_config(session_name, ssh_name, ssh_config):
         if key not in ["host", "login", "port", "keyfile", "preset", "parent"] and not key.startswith("$"):
             raise KeyError(f"ssh {session_name}.{ssh_name} contains an unknown key {key}")
 
+def verify_expand_config(session_name, window_name, expand_config):
+    if not isinstance(expand_config, dict) or len(expand_config) == 0:
+        raise TypeError(f"window {session_name}.{window_name} expand must be a non-empty dictionary")
+
+    for key, values in expand_config.items():
+        if not key.startswith("$"):
+            raise KeyError(f"window {session_name}.{window_name} expand key {key} must be a variable (start with $)")
+
+        if isarray(values):
+            if len(values) == 0:
+                raise TypeError(f"window {session_name}.{window_name} expand {key} must be a non-empty list")
+            continue
+
+        if not isinstance(values, dict) or len(values) != 1:
+            raise TypeError(f"window {session_name}.{window_name} expand {key} must be a list, range or file")
+
+        if "range" in values:
+            bounds = values["range"]
+            if not isarray(bounds) or len(bounds) != 2 or not all(isinstance(bound, int) for bound in bounds):
+                raise KeyError(f"window {session_name}.{window_name} expand {key} range must be a list of two integers")
+            if bounds[0] > bounds[1]:
+                raise KeyError(f"window {session_name}.{window_name} expand {key} range must be non-empty (first <= last)")
+        elif "file" in values:
+            if not isinstance(values["file"], str):
+                raise KeyError(f"window {session_name}.{window_name} expand {key} file must be a string")
+        else:
+            raise KeyError(f"window {session_name}.{window_name} expand {key} contains an unknown key {next(iter(values))}")
+
 def verify_window_config(session_name, window_name, window_config):
     if not isinstance(window_config, dict) and not window_config is None:
         raise TypeError(f"window {session_name}.{window_name} must be a dictionary or empty")
@@ -231,11 +268,17 @@ def verify_window_config(session_name, window_name, window_config):
     if "cmd" in window_config and not isinstance(window_config["cmd"], str):
         raise KeyError(f"window {session_name}.{window_name} cmd must be a string")
 
+    if "killtimeout" in window_config and (not isinstance(window_config["killtimeout"], (int, float)) or window_config["killtimeout"] < 0):
+        raise KeyError(f"window {session_name}.{window_name} killtimeout must be a non-negative number")
+
     if "ssh" in window_config:
         verify_ssh_config(session_name, window_name, window_config["ssh"])
 
+    if "expand" in window_config:
+        verify_expand_config(session_name, window_name, window_config["expand"])
+
     for key in window_config.keys():
-        if key not in ["home", "multihistory", "cmd", "ssh"]:
+        if key not in ["home", "multihistory", "cmd", "ssh", "expand", "killtimeout"]:
             raise KeyError(f"window {session_name}.{window_name} contains unknown key '{key}'")
 
 def verify_session_config(session_name, session_config):
@@ -258,8 +301,23 @@ def verify_session_config(session_name, session_config):
     if "multihistory" in session_config and not isinstance(session_config["multihistory"], bool):
         raise KeyError("multihistory must be a boolean")
 
+    if "killtimeout" in session_config and (not isinstance(session_config["killtimeout"], (int, float)) or session_config["killtimeout"] < 0):
+        raise KeyError(f"session {session_name} killtimeout must be a non-negative number")
+
+    if "rollout" in session_config:
+        rollout = session_config["rollout"]
+        if not isinstance(rollout, dict):
+            raise TypeError(f"session {session_name} rollout must be a dictionary")
+        if "size" in rollout and (not isinstance(rollout["size"], int) or rollout["size"] < 1):
+            raise KeyError(f"session {session_name} rollout size must be a positive integer")
+        if "delay" in rollout and (not isinstance(rollout["delay"], (int, float)) or rollout["delay"] <= 0):
+            raise KeyError(f"session {session_name} rollout delay must be a positive number")
+        for key in rollout:
+            if key not in ["size", "delay"]:
+                raise KeyError(f"session {session_name} rollout contains unknown key '{key}'")
+
     for key in session_config:
-        if key not in ["name", "home", "windows", "ssh", "multihistory"]:
+        if key not in ["name", "home", "windows", "ssh", "multihistory", "rollout", "killtimeout"]:
             raise KeyError(f"session {session_name} contains unknown key '{key}'")
 
     for window_name, window_config in session_config["windows"].items():
@@ -385,6 +443,49 @@ def fill_ssh_config(ssh_presets, ssh_config = None, preset_config = None, visite
 
     return ssh_config
 
+def expand_values(values):
+    if isarray(values):
+        yield from values
+    elif "range" in values:
+        first, last = values["range"]
+        yield from range(first, last + 1)
+    elif "file" in values:
+        with open(os.path.expanduser(values["file"]), "r") as stream:
+            for line in stream:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    yield line
+
+def expand_windows(session_name, windows):
+    for window_name, window in windows.items():
+        if not window or "expand" not in window:
+            yield window_name, copy.deepcopy(window)
+            continue
+
+        keys = list(window["expand"].keys())
+        value_lists = []
+        for key in keys:
+            value_lists.append(list(expand_values(window["expand"][key])))
+            if len(value_lists[-1]) == 0:
+                raise TypeError(f"window {session_name}.{window_name} expand {key} must be non-empty")
+
+        for values in itertools.product(*value_lists):
+            variables = {key[1:]: value for key, value in zip(keys, values)}
+            generated = copy.deepcopy(window)
+            del generated["expand"]
+
+            if "ssh" in generated:
+                ssh = generated["ssh"]
+                if isinstance(ssh, str): ssh = {"preset": ssh}
+                for key in ssh:
+                    if key.startswith("$") and key not in keys and isinstance(ssh[key], str):
+                        ssh[key] = template_replace(ssh[key], variables)
+                for key, value in zip(keys, values):
+                    ssh[key] = value
+                generated["ssh"] = ssh
+
+            yield template_replace(window_name, variables), generated
+
 def attach(session_name):
     exitcode = 0
 
@@ -415,6 +516,48 @@ def escape(cmd):
     result = "$'" + cmd.replace("\\", "\\\\").replace("'", "\\'") + "'"
     return result
 
+def execute_tmux(commands):
+    # tmux stops a command chain at the first failure (e.g. a pane that has just exited),
+    # so every command reports its progress and the chain is resumed after the failed one
+    output = ''
+    while len(commands) > 0:
+        chain = []
+        for i, command in enumerate(commands):
+            chain.append(command)
+            chain.append(f'display-message -p __pmux_done:{i}')
+        cmd = 'tmux ' + ' \\; '.join(chain)
+        if verbose: print(cmd)
+        result = subprocess.run(['/bin/bash', '-c', cmd], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        done = -1
+        for line in result.stdout.decode('utf8').splitlines():
+            if line.startswith('__pmux_done:'):
+                done = int(line[len('__pmux_done:'):])
+            else:
+                output += line + '\n'
+        commands = commands[done + 2:]
+    return output
+
+def list_panes():
+    panes = []
+    for line in execute('tmux list-panes -a -F "#{session_name} @*@ #{window_index} @*@ #{window_name} @*@ #{pane_id} @*@ #{pane_pid} @*@ #{pane_dead} @*@ #{pane_current_command} @*@ #{@killtimeout} @*@ #{pane_start_command}"').split('\n'):
+        if not line: continue
+        [session, window, name, pane_id, pid, dead, current_command, killtimeout, start_command] = line.split(' @*@ ', 8)
+        panes.append({'session': session, 'window': window, 'name': name, 'id': pane_id, 'pid': int(pid), 'dead': dead == '1',
+                      'command': current_command, 'start': start_command, 'killtimeout': float(killtimeout) if killtimeout else None})
+    return panes
+
+def signal_panes(panes, kill_signal):
+    if len(panes) == 0: return
+    pids = ','.join(str(pane['pid']) for pane in panes)
+    for line in execute(f'ps -o pid=,tpgid= -p {pids}', True).split('\n'):
+        if not line.strip(): continue
+        [pid, tpgid] = [int(value) for value in line.split()]
+        try:
+            if tpgid > 0: os.killpg(tpgid, kill_signal)
+            else: os.kill(pid, kill_signal)
+        except ProcessLookupError:
+            pass
+
 def isarray(var):
     return isinstance(var, list) and not isinstance(var, (str))
 
@@ -422,7 +565,11 @@ def start(config):
     setup_name = config['name']
     global_home_directory = config.get('home', None)
     global_multihistory = config.get('multihistory', None)
+    global_killtimeout = config.get('killtimeout', None)
     multihistory_path = f'~/.multihistory/{setup_name}/'
+    rollout = config.get('rollout', dict())
+    rollout_size = rollout.get('size', None)
+    rollout_delay = rollout.get('delay', 1)
     if not config['windows']: return
     windows = config['windows']
 
@@ -431,10 +578,16 @@ def start(config):
     
     fill_ssh_config(ssh_presets)
 
-    for window_name in windows.keys():
-        window = windows[window_name]
+    target_windows = NameCommandList()
+    kill_timeouts = dict()
 
-        if window and 'ssh' in window:
+    for window_name, window in expand_windows(setup_name, windows):
+        if target_windows.has_name(window_name):
+            raise KeyError(f"window {setup_name}.{window_name} is defined more than once")
+
+        if not window: window = dict()
+
+        if 'ssh' in window:
             ssh_template = fill_ssh_config(ssh_presets, window['ssh'])
             ssh_config = template_ssh_config(ssh_template)
 
@@ -445,23 +598,19 @@ def start(config):
 
             window['ssh'] = ssh_stages
 
-    target_windows = NameCommandList()
-
-    for window_name in windows.keys():
-        window = windows[window_name]
-        if not window: window = dict()
         history_arg = ''
         mkdirhistory_arg = ''
         home_arg = ''
         multihistory = window.get('multihistory', global_multihistory)
         home_directory = window.get('home', global_home_directory)
+        kill_timeouts[window_name] = window.get('killtimeout', global_killtimeout)
         
         if multihistory: 
-            history_arg = f'HISTFILE={multihistory_path}{window_name} '
+            history_arg = f'HISTFILE={multihistory_path}{shlex.quote(window_name)} '
             mkdirhistory_arg = f'mkdir -p {multihistory_path}; '
         if home_directory: home_arg = f'cd {home_directory}; '
 
-        command = f"{home_arg}{mkdirhistory_arg}{history_arg}PROMPT_COMMAND='history -a' /bin/bash"
+        command = f"{home_arg}{mkdirhistory_arg}{history_arg}PROMPT_COMMAND='history -a' {default_shell}"
 
         if window:
             if cmd := window.get('cmd', None):
@@ -512,11 +661,16 @@ def start(config):
                 execute(f'tmux kill-window -t {setup_name}:{index}')
                 open_windows.delete_index(index)
 
+    spawned = 0
+
     for [index, name, command] in target_windows:
         if not open_windows.has_name(name) or open_windows.get_command(open_windows.get_first_index_by_name(name)) != command:
+            if rollout_size and spawned > 0 and spawned % rollout_size == 0:
+                time.sleep(rollout_delay)
             free_index = not open_windows.has_index(index) and index or open_windows.first_free_index()
-            execute(f'tmux new-window -t {setup_name}:{free_index} -n {name} {command}')
+            execute(f'tmux new-window -t {setup_name}:{free_index} -n {shlex.quote(name)} {command}')
             open_windows.add(free_index, name, command)
+            spawned += 1
 
         open_index = open_windows.get_first_index_by_name(name)
         if open_index != index:
@@ -533,6 +687,11 @@ def start(config):
         execute(f'tmux set-hook -t {setup_name}:{index} pane-exited "tmux respawn-pane -t {setup_name}:{index}"')
         execute(f'tmux set-hook -t {setup_name}:{index} pane-died "tmux respawn-pane -t {setup_name}:{index}"')
 
+        if kill_timeouts[name] is not None:
+            execute(f'tmux set-window-option -t {setup_name}:{index} @killtimeout {kill_timeouts[name]}')
+        else:
+            execute(f'tmux set-window-option -u -t {setup_name}:{index} @killtimeout')
+
     if open_windows.has_name('_default'):
         execute(f'tmux kill-window -t {setup_name}:_default')
 
@@ -623,8 +782,79 @@ def run_kill(args):
             if not name in sessions:
                 raise Exception(f'no such session: {name}')
 
-    for name in names:
-        execute(f'tmux kill-session -t {name}')
+    if args.graceful:
+        kill_signal = None
+        if args.signal:
+            signal_name = args.signal.upper()
+            if not signal_name.isdigit() and not signal_name.startswith('SIG'): signal_name = 'SIG' + signal_name
+            try:
+                kill_signal = signal.Signals(int(signal_name)) if signal_name.isdigit() else signal.Signals[signal_name]
+            except (KeyError, ValueError):
+                raise Exception(f'no such signal: {args.signal}')
+        keys = args.keys
+        if keys is None and kill_signal is None: keys = 'C-c C-d'
+        kill_gracefully(names, keys, kill_signal, args.timeout)
+    else:
+        for name in names:
+            execute(f'tmux kill-session -t {name}')
+
+def kill_gracefully(names, keys, kill_signal, timeout, poll_interval = 0.2):
+    started = time.monotonic()
+    own_pane = os.environ.get('TMUX_PANE', None)
+    panes = [pane for pane in list_panes() if pane['session'] in names]
+    own_session = next((pane['session'] for pane in panes if pane['id'] == own_pane), None)
+    alive = [pane for pane in panes if not pane['dead'] and pane['id'] != own_pane]
+
+    commands = []
+    for session, window in sorted(set((pane['session'], pane['window']) for pane in panes)):
+        commands.append(f'set-hook -u -t {session}:{window} pane-exited')
+        commands.append(f'set-hook -u -t {session}:{window} pane-died')
+    execute_tmux(commands)
+
+    keys = keys and keys.split()
+    if keys:
+        # shells drop typeahead on interrupt, so each key goes to all panes before the next one
+        for i, key in enumerate(keys):
+            if i > 0: time.sleep(poll_interval)
+            execute_tmux([f'send-keys -t {pane["id"]} {key}' for pane in alive])
+
+    if kill_signal:
+        signal_panes(alive, kill_signal)
+
+    deadlines = dict()
+    for pane in alive:
+        killtimeout = pane['killtimeout']
+        deadlines[pane['id']] = started + (killtimeout if killtimeout is not None else timeout)
+
+    exited = 0
+    forced = 0
+
+    while alive:
+        time.sleep(poll_interval)
+        dead = {pane['id']: pane['dead'] for pane in list_panes()}
+        now = time.monotonic()
+        pending = []
+        for pane in alive:
+            if dead.get(pane['id'], True):
+                exited += 1
+            elif now >= deadlines[pane['id']]:
+                forced += 1
+            else:
+                pending.append(pane)
+        alive = pending
+
+        # the last key may have been dropped as well (e.g. C-d during the prompt redraw after C-c)
+        if keys:
+            execute_tmux([f'send-keys -t {pane["id"]} {keys[-1]}' for pane in alive])
+
+    sessions = execute('tmux list-sessions -F "#S"').split('\n')
+    execute_tmux([f'kill-session -t {name}' for name in names if name in sessions and name != own_session])
+
+    print(f'{len(names)} sessions killed in {time.monotonic() - started:.1f}s: {exited} panes exited, {forced} panes forced', flush=True)
+
+    # the session pmux runs in goes last, otherwise the report above is never shown
+    if own_session:
+        execute_tmux([f'kill-session -t {own_session}'])
 
 def run_reload(args):
     names = args.names
@@ -651,6 +881,118 @@ def run_reload(args):
             if dead == '1':
                 execute(f'tmux respawn-pane -t {name}:{index}')
 
+def capture_panes(panes, first_line = None):
+    separator = f'__pmux_capture_{os.getpid()}'
+    history_arg = first_line is not None and f' -S {first_line}' or ''
+    commands = []
+    for pane in panes:
+        commands.append(f'display-message -p -t {pane["id"]} "{separator}:#{{pane_id}}"')
+        commands.append(f'capture-pane -p -J -t {pane["id"]}{history_arg}')
+
+    captures = dict()
+    pane_id = None
+    for line in execute_tmux(commands).split('\n'):
+        if line.startswith(f'{separator}:%'):
+            pane_id = line[len(separator) + 1:]
+            captures[pane_id] = []
+        elif pane_id:
+            captures[pane_id].append(line.rstrip())
+    return captures
+
+def broadcast(panes, command, timeout, poll_interval, capture = False):
+    marker = f'__pmux_{os.getpid()}_{int(time.time())}'
+    status_re = re.compile(re.escape(marker) + r':(\d+)$')
+    started = time.monotonic()
+
+    # markers are printed with printf so the typed command line never matches them
+    typed = escape(f"printf '%s:start\\n' {marker}; {command}; printf '%s:%s\\n' {marker} $?")
+    commands = []
+    for pane in panes:
+        commands.append(f'send-keys -t {pane["id"]} -l {typed}')
+        commands.append(f'send-keys -t {pane["id"]} Enter')
+    execute_tmux(commands)
+
+    results = dict()
+    pending = list(panes)
+
+    while pending:
+        time.sleep(poll_interval)
+        # a finished command leaves its status line right above the prompt, so the visible screen is enough
+        captures = capture_panes(pending)
+        elapsed = time.monotonic() - started
+        still_pending = []
+        for pane in pending:
+            lines = captures.get(pane['id'], None)
+            if lines is None:
+                results[pane['id']] = ('gone', elapsed, '')
+            elif any(match := status_re.match(line) for line in lines):
+                results[pane['id']] = (match.group(1), elapsed, '')
+            elif elapsed >= timeout:
+                results[pane['id']] = ('timeout', elapsed, '')
+            else:
+                still_pending.append(pane)
+        pending = still_pending
+
+    if capture:
+        captures = capture_panes([pane for pane in panes if results[pane['id']][0] != 'gone'], '-')
+        for pane_id, lines in captures.items():
+            status, elapsed, _ = results[pane_id]
+            output_line = 0
+            last_line = len(lines)
+            for i, line in enumerate(lines):
+                if line == f'{marker}:start':
+                    output_line = i + 1
+                elif status_re.match(line):
+                    last_line = i
+                    break
+            results[pane_id] = (status, elapsed, '\n'.join(lines[output_line:last_line]).rstrip('\n'))
+
+    return results
+
+def run_exec(args):
+    own_pane = os.environ.get('TMUX_PANE', None)
+    panes = [pane for pane in list_panes() if not pane['dead'] and pane['id'] != own_pane]
+
+    if len(panes) == 0:
+        raise Exception('no sessions running')
+
+    targets = [f'{pane["session"]}:{pane["name"]}' for pane in panes]
+
+    if args.names:
+        chosen = [target for target in targets if any(fnmatch.fnmatchcase(target, name if ':' in name else name + ':*') for name in args.names)]
+        if len(chosen) == 0:
+            raise Exception(f'no windows match: {" ".join(args.names)}')
+    elif args.all:
+        chosen = targets
+    else:
+        chosen = choose_elements('windows to run command in', targets)
+
+    panes = [pane for pane, target in zip(panes, targets) if target in chosen]
+    if len(panes) == 0: return
+
+    # only panes waiting at a shell prompt (or in an ssh window) can take a typed command;
+    # cmd windows run under a shell too, but their start command is not the default shell
+    shell_panes = [pane for pane in panes if pane['command'].lstrip('-') in shell_commands and
+                   (not pane['start'] or pane['start'].rstrip('"\'\\ ').endswith(default_shell))]
+    results = broadcast(shell_panes, args.cmd, args.timeout, max(args.poll, 0.1), args.capture)
+    for pane in panes:
+        if pane not in shell_panes:
+            reason = pane['command'].lstrip('-') in shell_commands and 'running cmd' or f'running {pane["command"]}'
+            results[pane['id']] = ('skipped', None, reason)
+
+    width = max(len(target) for target in chosen + ['window'])
+    print(f'{"window":<{width}}  {"status":<7}  time')
+    for pane in panes:
+        status, elapsed, _ = results[pane['id']]
+        elapsed = elapsed is None and '-' or f'{elapsed:.1f}s'
+        print(f'{pane["session"] + ":" + pane["name"]:<{width}}  {status:<7}  {elapsed}')
+
+    if args.capture:
+        for pane in panes:
+            status, _, output = results[pane['id']]
+            print(f'\n--- {pane["session"]}:{pane["name"]} ({status}) ---')
+            print(output)
+
 parser = argparse.ArgumentParser(description='tmux session manager')
 subparsers = parser.add_subparsers(help='sub-command help', dest='command')
 
@@ -664,6 +1006,10 @@ start_parser.add_argument('files', nargs='*', help='yaml config files to start s
 kill_parser = subparsers.add_parser('k', description='kill sessions (session list or select at selection screen)')
 kill_parser.add_argument('-a', '--all', action='store_true', help='process all the sessions omitting selection screen')
 kill_parser.add_argument('-v', '--verbose', action='store_true', help='print tmux commands executed')
+kill_parser.add_argument('-g', '--graceful', action='store_true', help='ask panes to exit and wait for them before killing sessions')
+kill_parser.add_argument('-k', '--keys', help='key sequence sent to every pane in graceful mode (default: "C-c C-d" unless --signal is given)')
+kill_parser.add_argument('-s', '--signal', help='signal sent to foreground process of every pane in graceful mode (e.g. TERM, INT, HUP)')
+kill_parser.add_argument('-t', '--timeout', type=float, default=10, help='seconds to wait for panes in graceful mode unless window sets killtimeout (default: 10)')
 kill_parser.add_argument('names', nargs='*', help='session names to kill')
 
 attach_parser = subparsers.add_parser('a', description='attach to session (session name or select at selection screen)')
@@ -675,6 +1021,15 @@ reload_parser.add_argument('-v', '--verbose', action='store_true', help='print t
 reload_parser.add_argument('-a', '--all', action='store_true', help='process all the sessions omitting selection screen')
 reload_parser.add_argument('names', nargs='*', help='session names to reload')
 
+exec_parser = subparsers.add_parser('x', description='run command in windows (window list or select at selection screen) and report exit statuses')
+exec_parser.add_argument('-a', '--all', action='store_true', help='process all the windows of all the sessions omitting selection screen')
+exec_parser.add_argument('-n', '--names', nargs='*', help='windows to run command in, as session:window globs (session glob alone means all its windows)')
+exec_parser.add_argument('-t', '--timeout', type=float, default=60, help='seconds to wait for command to finish (default: 60)')
+exec_parser.add_argument('-p', '--poll', type=float, default=0.5, help='seconds between completion checks, at least 0.1 (default: 0.5)')
+exec_parser.add_argument('-c', '--capture', action='store_true', help='print output of every window after the status table')
+exec_parser.add_argument('-v', '--verbose', action='store_true', help='print tmux commands executed')
+exec_parser.add_argument('cmd', metavar='command', help='command to run (quoted)')
+
 help_parser = subparsers.add_parser('h', help='show help')
 
 subparsers_actions = [
@@ -695,6 +1050,8 @@ try:
         run_attach(args)
     elif args.command == 'r':
         run_reload(args)
+    elif args.command == 'x':
+        run_exec(args)
     elif args.command == 'h':
         for subparsers_action in subparsers_actions:
             for choice, subparser in subparsers_action.choices.items():